@@ -1,110 +1,267 @@
+import io
 import os
 import shutil
+import concurrent.futures
+import ctypes
 from PIL import Image, ImageDraw, ImageFont
 import zipfile
 import re
+import unicodedata
 import argparse
+from functools import lru_cache
+
+# Function to load the chapter title font, loaded once per font size
+@lru_cache(maxsize=None)
+def load_font(font_size):
+    # Use Monaco font (macOS default)
+    font_path = "/System/Library/Fonts/Monaco.ttf"  # Path for Monaco on macOS
+    try:
+        return ImageFont.truetype(font_path, font_size)
+    except IOError:
+        print("Warning: Monaco.ttf not found. Using default font, which may not support Vietnamese.")
+        return ImageFont.load_default()  # Fallback to default if Monaco is not available
+
+# Function to measure the width of a line, titles often repeat the same words
+@lru_cache(maxsize=4096)
+def _measure_line(text, font_size):
+    return load_font(font_size).getlength(text)  # Horizontal advance only, no bbox pass
 
 # Function to wrap text into multiple lines
-def wrap_text(text, draw, font, max_width):
+def wrap_text(text, font_size, max_width):
     lines = []
     words = text.split()
 
-    # Start with the first word
-    current_line = words[0]
+    # Measure each word and the space once, then pack lines by running sum
+    widths = [_measure_line(word, font_size) for word in words]
+    space = _measure_line(" ", font_size)
 
-    for word in words[1:]:
-        # Add word to the current line and check the width
-        test_line = current_line + " " + word
-        test_width = draw.textbbox((0, 0), test_line, font=font)[2]
+    # Start with the first word
+    start = 0
+    current_width = widths[0]
 
-        # If the line is too wide, move to the next line
-        if test_width <= max_width:
-            current_line = test_line
+    for i in range(1, len(words)):
+        # If adding the word makes the line too wide, move to the next line
+        if current_width + space + widths[i] <= max_width:
+            current_width += space + widths[i]
         else:
-            lines.append(current_line)
-            current_line = word  # Start a new line with the current word
+            lines.append(" ".join(words[start:i]))
+            start = i  # Start a new line with the current word
+            current_width = widths[i]
 
-    lines.append(current_line)  # Add the last line
+    lines.append(" ".join(words[start:]))  # Add the last line
 
     return lines
 
-# Function to create a text image for each subfolder (chapter)
-def create_text_image(chapter_name, output_path, size=(800, 1200), font_size=50):
-    image = Image.new("RGB", size, color="white")
-    draw = ImageDraw.Draw(image)
-
-    # Use Monaco font (macOS default)
-    font_path = "/System/Library/Fonts/Monaco.ttf"  # Path for Monaco on macOS
-    try:
-        font = ImageFont.truetype(font_path, font_size)
-    except IOError:
-        font = ImageFont.load_default()  # Fallback to default if Monaco is not available
-        print("Warning: Monaco.ttf not found. Using default font, which may not support Vietnamese.")
+# Function to compute the centered position of each line of a chapter title
+# Returns a list of (x, y, line)
+def _layout(chapter_name, font_size, size):
+    font = load_font(font_size)
 
     # Maximum width for text in the image
     max_width = size[0] - 40  # Leave padding on the sides
 
     # Wrap text to fit within the image width
-    lines = wrap_text(chapter_name, draw, font, max_width)
+    lines = wrap_text(chapter_name, font_size, max_width)
+
+    # Line height is constant for a font, measure it once
+    if hasattr(font, "getmetrics"):
+        ascent, descent = font.getmetrics()
+        line_height = ascent + descent
+    else:
+        line_height = font.getbbox("Ay")[3]  # Bitmap default font has no metrics
 
     # Calculate the height of the text block
-    total_text_height = sum(draw.textbbox((0, 0), line, font=font)[3] for line in lines)
+    total_text_height = line_height * len(lines)
     y_offset = (size[1] - total_text_height) // 2  # Vertically center the text
 
-    # Draw each line
+    layout = []
     for line in lines:
-        line_width = draw.textbbox((0, 0), line, font=font)[2]
-        x_offset = (size[0] - line_width) // 2  # Horizontally center each line
-        draw.text((x_offset, y_offset), line, font=font, fill="black")
-        y_offset += draw.textbbox((0, 0), line, font=font)[3]  # Move down for the next line
+        line_width = _measure_line(line, font_size)
+        x_offset = int(size[0] - line_width) // 2  # Horizontally center each line
+        layout.append((x_offset, y_offset, line))
+        y_offset += line_height  # Move down for the next line
 
-    # Save the image
-    image.save(output_path)
+    return layout
+
+# Function to rasterize a single character once, glyphs are reused across lines and chapters
+# Returns (mask, left, top, advance), mask is None for characters drawing nothing (spaces)
+@lru_cache(maxsize=None)
+def _glyph(char, font_size):
+    font = load_font(font_size)
+    left, top, right, bottom = font.getbbox(char)
+    advance = font.getlength(char)
+    if right <= left or bottom <= top:
+        return None, left, top, advance
+
+    mask = Image.new("L", (right - left, bottom - top), color=0)
+    ImageDraw.Draw(mask).text((-left, -top), char, font=font, fill=255)
+    return mask, left, top, advance
+
+# Function to create a text image for each subfolder (chapter)
+def create_text_image(chapter_name, output, size=(800, 1200), font_size=50):
+    image = Image.new("L", size, color=255)  # Black text on white only needs one channel
+
+    # Compose accents with their letters (macOS stores names decomposed), so each one is a single glyph
+    chapter_name = unicodedata.normalize("NFC", chapter_name)
+
+    # Draw each line by pasting cached glyphs, advancing by their width
+    for x_offset, y_offset, line in _layout(chapter_name, font_size, size):
+        x = x_offset
+        for char in line:
+            mask, left, top, advance = _glyph(char, font_size)
+            if mask is not None:
+                image.paste(0, (int(x) + left, y_offset + top), mask)
+            x += advance
+
+    # Save the image (output can be a path or a file object)
+    # A mostly white image compresses well even at the fastest level, and the CBZ stores it as is
+    image.save(output, "PNG", compress_level=1, optimize=False)
+
+# Pattern splitting a filename into text and number parts
+_NUM_RE = re.compile(r'(\d+)')
 
 # Natural sorting function to sort files and folders correctly
-def natural_sort_key(filename):
-    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', filename)]
+def natural_sort_key(filename, _split=_NUM_RE.split):
+    return [int(part) if part.isdigit() else part for part in _split(filename)]
 
-# Function to merge all subfolders into one without modifying the original folder
-def merge_folders(big_folder_path, output_folder, font_size):
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+# Worker rendering a chapter image to PNG bytes, run in a separate process
+def create_text_image_worker(task):
+    chapter_name, font_size = task
+    buf = io.BytesIO()
+    create_text_image(chapter_name, buf, font_size=font_size)
+    return buf.getvalue()
+
+# Function to collect all pages of all subfolders without modifying the original folder
+# Returns an ordered list of (source, arcname), where source is either the path of an
+# original image or the future PNG bytes of a chapter image being generated by executor
+def merge_folders(big_folder_path, font_size, executor):
+    pages = []
 
-    # Sort subfolders in natural order
-    subfolders = sorted(os.listdir(big_folder_path), key=natural_sort_key)
+    # Sort subfolders in natural order, scandir entries carry the file type so no extra stat is needed
+    with os.scandir(big_folder_path) as it:
+        subfolders = sorted((entry for entry in it if entry.is_dir()), key=lambda entry: natural_sort_key(entry.name))
     page_number = 1
 
     for subfolder in subfolders:
-        subfolder_path = os.path.join(big_folder_path, subfolder)
-        if os.path.isdir(subfolder_path):
-            # Generate chapter image in a temporary location (merged folder, not the original)
-            chapter_image_path = os.path.join(output_folder, f"{page_number:05}_00_{subfolder}.png")
-            create_text_image(subfolder, chapter_image_path, font_size=font_size)
-
-            page_number += 1  # Increment to account for the chapter image
-
-            # Copy all images to the output folder in natural order without modifying the original folder
-            images = sorted(os.listdir(subfolder_path), key=natural_sort_key)
-            for img in images:
-                src_img_path = os.path.join(subfolder_path, img)
-                dst_img_path = os.path.join(output_folder, f"{page_number:05}_{img}")
-                shutil.copyfile(src_img_path, dst_img_path)
-                page_number += 1
+        # Generate chapter image in memory in parallel, rendering is CPU-bound and holds the GIL
+        chapter_image = executor.submit(create_text_image_worker, (subfolder.name, font_size))
+        pages.append((chapter_image, f"{page_number:05}_00_{subfolder.name}.png"))
+
+        page_number += 1  # Increment to account for the chapter image
+
+        # Reference all images in natural order, they are read straight from the original folder
+        with os.scandir(subfolder.path) as it:
+            images = sorted((entry for entry in it if entry.is_file()), key=lambda entry: natural_sort_key(entry.name))
+        for img in images:
+            pages.append((img.path, f"{page_number:05}_{img.name}"))
+            page_number += 1
+
+    return pages
+
+# Buffer size used to copy pages into the CBZ file
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Linux fallocate(2), which fails on filesystems without support instead of emulating it.
+# os.posix_fallocate is not used: glibc emulates it by writing every block of the range
+# (NFSv3, FUSE/SMB mounts, ext3), which would write the whole CBZ file twice
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _fallocate = getattr(_libc, "fallocate64", None) or _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+    _fallocate = None  # Not Linux
+
+# Function to reserve disk space for the CBZ file before writing it, where supported (Linux)
+# Avoids block allocation during the write loop and keeps the file in few extents
+def _preallocate(f, pages, zinfos):
+    if _fallocate is None:
+        return
+
+    total = 22  # End of central directory record
+    for (source, arcname), zinfo in zip(pages, zinfos):
+        total += 30 + 46 + 2 * len(arcname.encode())  # Local header and central directory entry
+        if zinfo is not None:  # Chapter image sizes are not known yet
+            total += zinfo.file_size
+
+    # A failure (EOPNOTSUPP when the filesystem has no support) writes nothing, the file just grows as it is written
+    _fallocate(f.fileno(), 0, 0, total)
 
 # Function to create a CBZ file
-def create_cbz(output_folder, cbz_path):
-    with zipfile.ZipFile(cbz_path, 'w') as cbz:
-        for foldername, _, filenames in os.walk(output_folder):
-            for filename in sorted(filenames, key=natural_sort_key):
-                filepath = os.path.join(foldername, filename)
-                cbz.write(filepath, os.path.relpath(filepath, output_folder))
+# Images are already compressed (JPEG/PNG/WebP), so they are stored without deflate
+# Pages are written as soon as they are ready, while later chapter images are still
+# being generated
+def create_cbz(pages, cbz_path):
+    # Stat every original once, the same ZipInfo sizes the preallocation and writes the entry
+    zinfos = [None if isinstance(source, concurrent.futures.Future) else zipfile.ZipInfo.from_file(source, arcname)
+              for source, arcname in pages]
+
+    with open(cbz_path, 'wb') as f:
+        _preallocate(f, pages, zinfos)
+
+        try:
+            with zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_STORED) as cbz:
+                for (source, arcname), zinfo in zip(pages, zinfos):
+                    if zinfo is None:
+                        cbz.writestr(arcname, source.result())
+                    else:
+                        # Same as cbz.write, with a larger buffer than its 8 KB chunks
+                        zinfo.compress_type = zipfile.ZIP_STORED
+                        with open(source, 'rb', buffering=_COPY_BUFFER_SIZE) as src, cbz.open(zinfo, 'w') as dst:
+                            shutil.copyfileobj(src, dst, length=_COPY_BUFFER_SIZE)
+        finally:
+            # Drop what was preallocated but not used, the archive must end with its end record,
+            # also when writing failed and ZipFile only closed a partial archive
+            f.truncate()
+
+# Function to copy a page without moving its bytes when possible
+# Pages are never modified, so a hard link is as good as a copy
+def _fast_copy(src, dst):
+    # Never open an existing destination for writing, it may be a hard link to the original
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        os.link(src, dst)  # Same filesystem: metadata only
+        return
+    except OSError:
+        pass  # Cross-device or links not supported
+
+    if hasattr(os, "copy_file_range"):  # Linux: lets the filesystem share extents (reflink)
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
+
+# Function to write all pages into a merged folder, next to the CBZ file
+def create_folder(pages, output_folder):
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    for source, arcname in pages:
+        dst_path = os.path.join(output_folder, arcname)
+        if isinstance(source, concurrent.futures.Future):
+            with open(dst_path, 'wb') as f:
+                f.write(source.result())
+        else:
+            _fast_copy(source, dst_path)
 
 # Main function
 def main():
     parser = argparse.ArgumentParser(description="Merge images into CBZ and add chapter title images.")
     parser.add_argument("-fz", "--font_size", type=int, default=50, help="Set custom font size for chapter title image.")
     parser.add_argument("-fn", "--file_name", type=str, help="Set custom CBZ filename.")
+    parser.add_argument("-kf", "--keep_folder", action="store_true", help="Also create the merged folder next to the CBZ file.")
     args = parser.parse_args()
 
     # Display message about options
@@ -130,11 +287,15 @@ def main():
     cbz_file = os.path.join(script_dir, cbz_filename)
 
     # Merge folders and generate CBZ
-    merge_folders(big_folder_path, output_folder, font_size=args.font_size)
-    create_cbz(output_folder, cbz_file)
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        pages = merge_folders(big_folder_path, font_size=args.font_size, executor=executor)
+        create_cbz(pages, cbz_file)
 
     print(f"CBZ file created at {cbz_file}")
-    print(f"Merged folder created at {output_folder}")
+
+    if args.keep_folder:
+        create_folder(pages, output_folder)
+        print(f"Merged folder created at {output_folder}")
 
 if __name__ == "__main__":
     main()